@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
 import csv
+import hashlib
+import io
 import json
+import mmap
+import os
+import struct
+from array import array
 from typing import List, Optional
 import click
 
@@ -23,6 +29,32 @@ series_map = {
     "SNW": "Strange New Worlds",
 }
 
+name_aliases = {
+    "Prophesy": "Prophecy",
+    "Inter Arma Silent Leges": "Inter Arma Enim Silent Leges",
+    "Vis a Vis": "Vis À Vis",
+    "Menage a Troi": "Ménage à Troi",
+    "When The Bow Breaks": "When the Bough Breaks",
+    "Is There No Truth in Beauty?": "Is There in Truth No Beauty?",
+    "Momento Mori": "Memento Mori",
+    "The Butchers Knife Cares Not for the Lambs Cry": "The Butcher's Knife Cares Not for the Lamb's Cry",
+    "Battle of the Binary Stars": "Battle at the Binary Stars",
+    "E-Squared": "E²",
+    "Vox": "Võx",
+    "I, Excretes": "I, Excretus",
+}
+
+# (name, season) -> (season, episode) for entries the list numbers differently than Jellyfin
+entry_renumbers = {
+    ("The Cage", 0): (1, 0),
+}
+
+
+def rules_fingerprint():
+    rules = (sorted(series_map.items()), sorted(name_aliases.items()), sorted(entry_renumbers.items()))
+    return hashlib.sha256(repr(rules).encode("utf-8")).digest()
+
+
 class VideoEntry:
     def __init__(self, name: str, parent: str, season: Optional[int], episode: Optional[int]):
         self.name = name
@@ -32,35 +64,15 @@ class VideoEntry:
         self.episode = episode
         self._series = None
 
-        self.name = self.name.replace("’", "'").replace("…", "...")
-        if self.name == "Prophesy":
-            self.name = "Prophecy"
-        if self.name == "Inter Arma Silent Leges":
-            self.name = "Inter Arma Enim Silent Leges"
-        if self.name == "Vis a Vis":
-            self.name = "Vis À Vis"
-        if self.name == "Menage a Troi":
-            self.name = "Ménage à Troi"
-        if self.name == "When The Bow Breaks":
-            self.name = "When the Bough Breaks"
-        if self.name == "Is There No Truth in Beauty?":
-            self.name = "Is There in Truth No Beauty?"
-        if self.name == "Momento Mori":
-            self.name = "Memento Mori"
-        if self.name == "The Butchers Knife Cares Not for the Lambs Cry":
-            self.name = "The Butcher's Knife Cares Not for the Lamb's Cry"
-        if self.name == "Battle of the Binary Stars":
-            self.name = "Battle at the Binary Stars"
-        if self.name == "E-Squared":
-            self.name = "E²"
-        if self.name == "Vox":
-            self.name = "Võx"
-        if self.name == "I, Excretes":
-            self.name = "I, Excretus"
-
-        if self.name == "The Cage" and self.season == 0:
-            self.season = 1
-            self.episode = 0
+    @staticmethod
+    def from_row(name: str, parent: str, season: Optional[int], episode: Optional[int]):
+        name = name.replace("’", "'").replace("…", "...")
+        name = name_aliases.get(name, name)
+
+        if (name, season) in entry_renumbers:
+            season, episode = entry_renumbers[(name, season)]
+
+        return VideoEntry(name, parent.upper(), season, episode)
 
     def series_name(self):
         if self.is_movie:
@@ -75,23 +87,189 @@ class VideoEntry:
         return self._series
 
 
+class ChronoListError(Exception):
+    def __init__(self, errors: List[str]):
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+
 class ChronoList:
+    """list of videos in chronological order
+
+       The pipe-delimited source file is validated and compiled once into a binary cache next to it
+       (<file>.compiled). The cache is keyed by a fingerprint of series_map, name_aliases and
+       entry_renumbers, and by the sha256 of the source, so it is rebuilt when either changes. The
+       source is only re-hashed when its size or mtime differ from the ones stored in the cache.
+
+       Cache layout (native byte order):
+         header: magic, version, rules fingerprint, source sha256, source size, source mtime, video count
+         uint32[count + 1] character offsets into the names
+         int16[count] seasons (-1 for none)
+         int16[count] episodes (-1 for none)
+         3 bytes per video: series code
+         utf-8 names, concatenated
+    """
+
+    CACHE_MAGIC = b"JTCL"
+    CACHE_VERSION = 2
+    CACHE_HEADER = struct.Struct("=4sH32s32sQqI")
+
     def __init__(self):
         self.videos: List[VideoEntry] = []
 
     def load_from_file(self, file_path: str):
-        with open(file_path, "r") as file:
-            reader = csv.reader(file, delimiter='|')
-            header = None
-            for row in reader:
-                if not header:
-                    header = row
+        cache_path = file_path + ".compiled"
+        rules = rules_fingerprint()
+        stat = os.stat(file_path)
+        if self.load_from_cache(cache_path, rules, stat):
+            return
+
+        with open(file_path, "rb") as file:
+            source = file.read()
+        digest = hashlib.sha256(source).digest()
+        if not self.load_from_cache(cache_path, rules, stat, digest):
+            self.videos = ChronoList.compile(source.decode("utf-8"))
+
+        # rewrite even when only the mtime changed, so the next load can skip hashing again
+        try:
+            self.write_cache(cache_path, rules, digest, stat)
+        except OSError as e:
+            print(f"Cannot write compiled chrono list {cache_path}: {e}")
+
+    @staticmethod
+    def compile(text: str):
+        """parse and validate the source, raising ChronoListError with every problem found
+        """
+        videos = []
+        errors = []
+        seen = {}
+
+        reader = csv.reader(io.StringIO(text), delimiter='|')
+        next(reader, None)
+        for row in reader:
+            line = reader.line_num
+            if not row:
+                continue
+            while len(row) > 4 and not row[-1].strip():
+                row.pop()
+            if len(row) != 4:
+                errors.append(f"line {line}: expected 4 fields, got {len(row)}")
+                continue
+
+            parent = row[0].strip().upper()
+            name = row[3].strip()
+            is_movie = parent == "MOV"
+            if not is_movie and parent not in series_map:
+                errors.append(f"line {line}: unknown series: {parent}")
+                continue
+            if not name:
+                errors.append(f"line {line}: missing name")
+                continue
+
+            numbers = []
+            for field, value in (("season", row[1].strip()), ("episode", row[2].strip())):
+                if not value:
+                    if not is_movie:
+                        errors.append(f"line {line}: {parent} {name} is missing its {field}")
+                    numbers.append(None)
+                elif is_movie:
+                    errors.append(f"line {line}: movie {name} should not have a {field}")
+                    numbers.append(None)
+                elif not (value.isascii() and value.isdecimal()) or int(value) > 0x7fff:
+                    errors.append(f"line {line}: bad {field} number: {value}")
+                    numbers.append(None)
                 else:
-                    name = row[3]
-                    parent = row[0]
-                    season = int(row[1]) if row[1] else None
-                    episode = int(row[2]) if row[2] else None
-                    self.videos.append(VideoEntry(name, parent, season, episode))
+                    numbers.append(int(value))
+            if not is_movie and None in numbers:
+                continue
+
+            entry = VideoEntry.from_row(name, parent, numbers[0], numbers[1])
+            key = entry.name if entry.is_movie else (entry.parent, entry.season, entry.episode)
+            if key in seen:
+                errors.append(f"line {line}: duplicate of line {seen[key]}: {parent} {row[1]} {row[2]} {name}")
+                continue
+            seen[key] = line
+            videos.append(entry)
+
+        if errors:
+            raise ChronoListError(errors)
+        return videos
+
+    def load_from_cache(self, cache_path: str, rules: bytes, stat: os.stat_result, digest: Optional[bytes] = None):
+        """load the cache if it was built with the same rules and from the same source
+
+           Without a digest, the source's size and mtime have to match the ones in the cache.
+        """
+        header = ChronoList.CACHE_HEADER
+        try:
+            with open(cache_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if len(data) < header.size:
+                    return False
+                magic, version, cached_rules, cached_digest, size, mtime_ns, count = header.unpack_from(data)
+                if magic != ChronoList.CACHE_MAGIC or version != ChronoList.CACHE_VERSION or cached_rules != rules:
+                    return False
+                if digest is None and (size != stat.st_size or mtime_ns != stat.st_mtime_ns):
+                    return False
+                if digest is not None and cached_digest != digest:
+                    return False
+
+                pos = header.size
+                offsets = array("I", data[pos:pos + 4 * (count + 1)])
+                pos += 4 * (count + 1)
+                seasons = array("h", data[pos:pos + 2 * count])
+                pos += 2 * count
+                episodes = array("h", data[pos:pos + 2 * count])
+                pos += 2 * count
+                codes = data[pos:pos + 3 * count].decode("ascii")
+                pos += 3 * count
+                names = data[pos:].decode("utf-8")
+        except (OSError, ValueError):
+            return False
+        if len(offsets) != count + 1 or len(codes) != 3 * count or offsets[count] != len(names):
+            return False
+
+        self.videos = [
+            VideoEntry(names[offsets[i]:offsets[i + 1]], codes[3 * i:3 * i + 3],
+                       season if season >= 0 else None, episode if episode >= 0 else None)
+            for i, (season, episode) in enumerate(zip(seasons, episodes))
+        ]
+        return True
+
+    def write_cache(self, cache_path: str, rules: bytes, digest: bytes, stat: os.stat_result):
+        offsets = array("I", [0])
+        seasons = array("h")
+        episodes = array("h")
+        codes = bytearray()
+        names = []
+        for video in self.videos:
+            names.append(video.name)
+            offsets.append(offsets[-1] + len(video.name))
+            seasons.append(video.season if video.season is not None else -1)
+            episodes.append(video.episode if video.episode is not None else -1)
+            codes += video.parent.encode("ascii")
+
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(ChronoList.CACHE_HEADER.pack(ChronoList.CACHE_MAGIC, ChronoList.CACHE_VERSION, rules, digest,
+                                                    stat.st_size, stat.st_mtime_ns, len(self.videos)))
+            file.write(offsets.tobytes())
+            file.write(seasons.tobytes())
+            file.write(episodes.tobytes())
+            file.write(codes)
+            file.write("".join(names).encode("utf-8"))
+        os.replace(tmp_path, cache_path)
+
+
+def load_chrono_list(chrono_list_file: str):
+    chrono_list = ChronoList()
+    try:
+        chrono_list.load_from_file(chrono_list_file)
+    except ChronoListError as e:
+        print(f"Invalid chrono list {chrono_list_file}:")
+        for error in e.errors:
+            print(f"  {error}")
+        exit(1)
+    return chrono_list
 
 
 def matches_series(series: Series, entry: VideoEntry):
@@ -131,7 +309,7 @@ def matches_episode(video: Video, entry: VideoEntry):
     return False
 
 
-def ids_for_playlist(chrono_list_file: str, movies: Library, shows: Library):
+def ids_for_playlist(chrono_list: ChronoList, movies: Library, shows: Library):
     ids = []
     names = []
 
@@ -139,21 +317,16 @@ def ids_for_playlist(chrono_list_file: str, movies: Library, shows: Library):
     unmatched_count = 0
     merged_count = 0
 
-    chrono_list = ChronoList()
-    chrono_list.load_from_file(chrono_list_file)
     prev_entry = None
     prev_video = None
     for entry in chrono_list.videos:
         if entry.is_movie:
-            found = False
-            for id, movie in movies.jf_items.items():
-                if movie.Name == entry.name or (movie.Name == "Star Trek" and entry.name == "Star Trek (2009)"):
-                    ids.append(movie.Id)
-                    names.append(movie.Name)
-                    matched_count += 1
-                    found = True
-                    break
-            if not found:
+            movie = movies.find_movie(entry.name)
+            if movie:
+                ids.append(movie.Id)
+                names.append(movie.Name)
+                matched_count += 1
+            else:
                 unmatched_count += 1
                 print(f"{entry.name}: id=None")
         else:
@@ -235,6 +408,7 @@ def cli(ctx, url: str, user_id: str, token: str, device_id: str):
 def check_videos(context: CliContext, chrono_list_file: str):
     """check your Jellyfin instance for the videos in the input file
     """
+    chrono_list = load_chrono_list(chrono_list_file)
     libraries = build_libraries(context.client, context.user_id)
     movies : Library = None
     shows : Library = None
@@ -257,7 +431,7 @@ def check_videos(context: CliContext, chrono_list_file: str):
         print("Cannot get all items from 'TV Shows'")
         exit(2)
 
-    ids_for_playlist(chrono_list_file, movies, shows)
+    ids_for_playlist(chrono_list, movies, shows)
 
 
 @cli.command("check-playlist")
@@ -267,6 +441,7 @@ def check_videos(context: CliContext, chrono_list_file: str):
 def check_playlist(context: CliContext, chrono_list_file: str, name: str):
     """check your Jellyfin playlist for the videos in the input file
     """
+    chrono_list = load_chrono_list(chrono_list_file)
     libraries = build_libraries(context.client, context.user_id)
     movies : Library = None
     shows : Library = None
@@ -289,7 +464,7 @@ def check_playlist(context: CliContext, chrono_list_file: str, name: str):
         print("Cannot get all items from 'TV Shows'")
         exit(2)
 
-    ids, names = ids_for_playlist(chrono_list_file, movies, shows)
+    ids, names = ids_for_playlist(chrono_list, movies, shows)
     jf_playlist = build_playlist(context.client, context.user_id, name)
 
     if len(ids) != len(jf_playlist.videos):
@@ -307,6 +482,7 @@ def check_playlist(context: CliContext, chrono_list_file: str, name: str):
 def create_playlist(context: CliContext, chrono_list_file: str, name: str):
     """create a Jellyfin playlist of the videos in the input file
     """
+    chrono_list = load_chrono_list(chrono_list_file)
     libraries = build_libraries(context.client, context.user_id)
     movies : Library = None
     shows : Library = None
@@ -329,7 +505,7 @@ def create_playlist(context: CliContext, chrono_list_file: str, name: str):
         print("Cannot get all items from 'TV Shows'")
         exit(2)
 
-    ids, _ = ids_for_playlist(chrono_list_file, movies, shows)
+    ids, _ = ids_for_playlist(chrono_list, movies, shows)
     create_jf_playlist(context.client, context.user_id, name, ids)
 
 
@@ -344,6 +520,7 @@ def update_playlist(context: CliContext, chrono_list_file: str, name: str):
 
        Moving new items in the correct place in the playlist doesn't seem to be working
     """
+    chrono_list = load_chrono_list(chrono_list_file)
     libraries = build_libraries(context.client, context.user_id)
     movies : Library = None
     shows : Library = None
@@ -366,7 +543,7 @@ def update_playlist(context: CliContext, chrono_list_file: str, name: str):
         print("Cannot get all items from 'TV Shows'")
         exit(2)
 
-    ids, names = ids_for_playlist(chrono_list_file, movies, shows)
+    ids, names = ids_for_playlist(chrono_list, movies, shows)
     jf_playlist = build_playlist(context.client, context.user_id, name)
 
     if len(ids) <= len(jf_playlist.videos):
@@ -1,4 +1,5 @@
-from typing import Any, Dict, List, Optional, Union
+import re
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from jellyfin_api_client import Client
 from jellyfin_api_client.api.items import get_items_by_user_id
@@ -7,6 +8,17 @@ from jellyfin_api_client.models.base_item_dto_query_result import BaseItemDtoQue
 from jellyfin_api_client.models.create_playlist_dto import CreatePlaylistDto
 
 
+def normalize_title(title: str):
+    return " ".join(title.replace("’", "'").casefold().split())
+
+
+def split_title_year(title: str):
+    match = re.fullmatch(r"(.*\S)\s*\((\d{4})\)", title.strip())
+    if match:
+        return match.group(1), int(match.group(2))
+    return title, None
+
+
 class JFItem:
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
@@ -43,6 +55,45 @@ class Library(JFItem):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.jf_items : Dict[str, Union[Series, Video]] = {}
+        self.movies_by_title : Dict[str, List[Video]] = {}
+        self.movies_by_title_year : Dict[Tuple[str, int], List[Video]] = {}
+
+    def build_movie_index(self):
+        self.movies_by_title = {}
+        self.movies_by_title_year = {}
+        for _, item in self.jf_items.items():
+            if isinstance(item, Video):
+                title = normalize_title(item.Name)
+                self.movies_by_title.setdefault(title, []).append(item)
+                year = getattr(item, "ProductionYear", None)
+                if year:
+                    self.movies_by_title_year.setdefault((title, year), []).append(item)
+
+    def find_movie(self, name: str):
+        """find a movie by name, using a trailing "(year)" to pick between same-title movies
+
+           Returns None when the name is ambiguous, so it is reported instead of matched to the wrong movie.
+        """
+        title, year = split_title_year(name)
+
+        candidates = self.movies_by_title.get(normalize_title(name), [])
+        if year is not None and len(candidates) > 1:
+            candidates = [movie for movie in candidates if getattr(movie, "ProductionYear", None) == year]
+        if candidates:
+            return candidates[0] if len(candidates) == 1 else None
+
+        if year is None:
+            return None
+        title = normalize_title(title)
+        candidates = self.movies_by_title_year.get((title, year), [])
+        if candidates:
+            return candidates[0] if len(candidates) == 1 else None
+
+        # Jellyfin may not know the year, so fall back to the title when the only movie with it has no year
+        candidates = self.movies_by_title.get(title, [])
+        if len(candidates) == 1 and not getattr(candidates[0], "ProductionYear", None):
+            return candidates[0]
+        return None
 
     def populate_tree_from_items(self, items: List[Dict[Any, Any]]):
         videos = []
@@ -72,14 +123,19 @@ class Library(JFItem):
             else:
                 parentless_seasons.append(season)
 
+        seasons_by_id : Dict[str, Season] = {}
+        for _, item in self.jf_items.items():
+            if isinstance(item, Series):
+                seasons_by_id.update(item.seasons)
+
         for video in videos:
-            for _, series in self.jf_items.items():
-                if hasattr(video, "SeasonId") and video.SeasonId in series.seasons:
-                    series.seasons[video.SeasonId].videos.append(video)
-                    break
+            if hasattr(video, "SeasonId") and video.SeasonId in seasons_by_id:
+                seasons_by_id[video.SeasonId].videos.append(video)
             else:
                 self.jf_items[video.Id] = video
 
+        self.build_movie_index()
+
 
 class VideoPlaylist(JFItem):
     def __init__(self, *args, **kwargs):